@@ -1,32 +1,308 @@
 from pathlib import Path
+from concurrent.futures import Future, ThreadPoolExecutor, wait, FIRST_COMPLETED
+from contextlib import contextmanager
+from typing import Union, List, Optional, Iterator, Set, Tuple
+import logging
+import os
 import shutil
-from typing import Union
+import threading
+import uuid
 
+logger = logging.getLogger(__name__)
 
 
 class FolderManagement:
+    # Runs the removal of tombstoned directories off the calling thread
+    __cleanup_executor: Optional[ThreadPoolExecutor] = None
+    __cleanup_workers: int = 2
+    # Shared by all removals to scan directories and unlink files in parallel
+    __scan_executor: Optional[ThreadPoolExecutor] = None
+    __scan_workers: int = min(32, (os.cpu_count() or 1) + 4)
+    # Trees with up to this many directories are removed on the calling thread
+    __serial_directory_limit: int = 8
+    __executor_lock: threading.Lock = threading.Lock()
+    __pending_cleanups: Set[Future] = set()
+    # Tombstones queued or being removed and staging directories in use, skipped by cleanup_tombstones
+    __active_paths: Set[Path] = set()
 
     @staticmethod
-    def create_directory(path_to_create: Union[Path, str], remove_if_exists: bool = True) -> Path:
-        try:
-            if isinstance(path_to_create, str):
-                path_to_create: Path = Path(path_to_create)
+    def create_directory(path_to_create: Union[Path, str], remove_if_exists: bool = True,
+                         atomic: bool = False) -> Path:
+        """
+        Creates the given directory
+        @param path_to_create: The directory to create
+        @param remove_if_exists: Should an existing directory be removed before creating it again
+        @param atomic: If True, an existing directory is renamed to a tombstone and deleted in the background,
+        so the call returns without waiting for the old tree to be removed.
+        Errors of the background removal are logged, see wait_for_cleanup and cleanup_tombstones.
+        Pending removals are finished before the interpreter exits, so removing a large tree can delay shutdown.
+        @return: The path of the created directory
+        """
+        if isinstance(path_to_create, str):
+            path_to_create: Path = Path(path_to_create)
 
-            if path_to_create.exists() and remove_if_exists:
+        if path_to_create.exists() and remove_if_exists:
+            if not path_to_create.is_dir():
+                raise NotADirectoryError(f"Not a directory: {path_to_create}")
+            if atomic:
+                FolderManagement.delete_directory(path_to_create, background=True)
+            else:
                 shutil.rmtree(path_to_create)
-            path_to_create.mkdir(parents=True, exist_ok=True)
-            return path_to_create
-
-        except BaseException as ex:
-            raise
+        path_to_create.mkdir(parents=True, exist_ok=True)
+        return path_to_create
 
     @staticmethod
-    def delete_directory(path_to_delete: Union[Path, str]):
+    def delete_directory(path_to_delete: Union[Path, str], background: bool = False) -> Optional[Future]:
+        """
+        Deletes the given directory. Symbolic links are refused, as the link target would be emptied otherwise.
+        @param path_to_delete: The directory to delete
+        @param background: If True, the directory is renamed to a tombstone and removed by a background worker.
+        Pending removals are finished before the interpreter exits, so removing a large tree can delay shutdown.
+        @return: None for a foreground delete, otherwise a future which resolves to the list of errors
+        encountered while removing the tombstone. Non-empty error lists are logged as well.
+        """
         if isinstance(path_to_delete, str):
             path_to_delete: Path = Path(path_to_delete)
 
-        if path_to_delete.exists():
+        if os.path.islink(path_to_delete):
+            raise OSError(f"Cannot delete a symbolic link: {path_to_delete}")
+
+        if not path_to_delete.exists():
+            return None
+
+        if not path_to_delete.is_dir():
+            raise NotADirectoryError(f"Not a directory: {path_to_delete}")
+
+        if not background:
+            FolderManagement.__raise_errors(path_to_delete, FolderManagement.__remove_tree(path_to_delete))
+            return None
+
+        return FolderManagement.__submit_cleanup(FolderManagement.__tombstone(path_to_delete))
+
+    @staticmethod
+    def cleanup_tombstones(directory: Union[Path, str]) -> List[Path]:
+        """
+        Removes tombstones and staging directories left behind in the given directory, e.g. by failed
+        background removals or by a process being killed before a removal or a staged write finished.
+        Tombstones still being removed and staging directories still in use by this process are skipped.
+        Staging directories of other processes can not be detected, so do not run this while another process
+        writes staged directories into the same directory.
+        @param directory: The directory containing the tombstones
+        @return: The removed tombstones and staging directories
+        """
+        if isinstance(directory, str):
+            directory: Path = Path(directory)
+
+        with FolderManagement.__executor_lock:
+            active_paths: Set[Path] = set(FolderManagement.__active_paths)
+
+        candidates: Set[Path] = set(directory.glob(".*.trash-*")) | set(directory.glob(".*.staging-*"))
+        tombstones: List[Path] = sorted(path for path in candidates if path.absolute() not in active_paths
+                                        and path.is_dir() and not path.is_symlink())
+        for tombstone in tombstones:
+            FolderManagement.delete_directory(tombstone)
+
+        return tombstones
+
+    @staticmethod
+    def wait_for_cleanup(timeout: Optional[float] = None) -> bool:
+        """
+        Waits for all background removals to finish
+        @param timeout: The maximum number of seconds to wait
+        @return: True if all background removals are finished
+        """
+        with FolderManagement.__executor_lock:
+            pending: List[Future] = list(FolderManagement.__pending_cleanups)
+
+        _, not_done = wait(pending, timeout=timeout)
+        return len(not_done) == 0
+
+    @staticmethod
+    @contextmanager
+    def staged_directory(target_path: Union[Path, str]) -> Iterator[Path]:
+        """
+        Provides a staging directory next to the target path. Once the block completes, an existing target
+        is renamed to a tombstone and the staging directory is renamed to the target path, so readers never see
+        a partially populated folder. Between both renames the target path briefly does not exist.
+        If the block or the rename of the staging directory fails, the staging directory is removed and the
+        previous target is restored.
+        @param target_path: The final directory
+        @return: The staging directory to write into
+        """
+        if isinstance(target_path, str):
+            target_path: Path = Path(target_path)
+
+        target_path.parent.mkdir(parents=True, exist_ok=True)
+        staging_path: Path = Path(target_path.parent, f".{target_path.name}.staging-{uuid.uuid4().hex}")
+        with FolderManagement.__executor_lock:
+            FolderManagement.__active_paths.add(staging_path.absolute())
+
+        try:
+            staging_path.mkdir()
+
+            try:
+                yield staging_path
+            except BaseException:
+                FolderManagement.delete_directory(staging_path, background=True)
+                raise
+
+            tombstone: Optional[Path] = None
             try:
-                shutil.rmtree(path_to_delete)
-            except:
-                return
+                if os.path.lexists(target_path):
+                    tombstone = FolderManagement.__tombstone(target_path)
+                os.replace(staging_path, target_path)
+            except BaseException:
+                if tombstone is not None:
+                    try:
+                        os.replace(tombstone, target_path)
+                    except OSError:
+                        logger.error(f"Could not restore {target_path}, previous content remains in {tombstone}, "
+                                     f"move it back before running cleanup_tombstones")
+                    FolderManagement.__release(tombstone)
+                FolderManagement.delete_directory(staging_path, background=True)
+                raise
+
+            if tombstone is not None:
+                if os.path.islink(tombstone):
+                    os.unlink(tombstone)
+                    FolderManagement.__release(tombstone)
+                else:
+                    FolderManagement.__submit_cleanup(tombstone)
+        finally:
+            FolderManagement.__release(staging_path)
+
+    @staticmethod
+    def __tombstone(path: Path) -> Path:
+        tombstone: Path = Path(path.parent, f".{path.name}.trash-{uuid.uuid4().hex}")
+        # Registered before the rename, so cleanup_tombstones never sees an untracked tombstone
+        with FolderManagement.__executor_lock:
+            FolderManagement.__active_paths.add(tombstone.absolute())
+        try:
+            os.replace(path, tombstone)
+        except BaseException:
+            FolderManagement.__release(tombstone)
+            raise
+        return tombstone
+
+    @staticmethod
+    def __release(path: Path):
+        with FolderManagement.__executor_lock:
+            FolderManagement.__active_paths.discard(path.absolute())
+
+    @staticmethod
+    def __raise_errors(path: Path, errors: List[OSError]):
+        if len(errors) > 0:
+            raise OSError(f"Could not delete {len(errors)} entries of {path}") from errors[0]
+
+    @staticmethod
+    def __submit_cleanup(tombstone: Path) -> Future:
+        """
+        Queues the removal of a tombstone created by __tombstone
+        """
+        with FolderManagement.__executor_lock:
+            if FolderManagement.__cleanup_executor is None:
+                FolderManagement.__cleanup_executor = ThreadPoolExecutor(
+                    max_workers=FolderManagement.__cleanup_workers, thread_name_prefix="folder-cleanup")
+            future: Future = FolderManagement.__cleanup_executor.submit(FolderManagement.__remove_tree, tombstone)
+            FolderManagement.__pending_cleanups.add(future)
+
+        def on_done(done: Future):
+            with FolderManagement.__executor_lock:
+                FolderManagement.__pending_cleanups.discard(done)
+                FolderManagement.__active_paths.discard(tombstone.absolute())
+
+            if done.exception() is not None:
+                logger.error(f"Background removal of {tombstone} failed: {done.exception()}")
+            elif len(done.result()) > 0:
+                logger.error(f"Background removal of {tombstone} failed with {len(done.result())} errors, "
+                             f"first error: {done.result()[0]}")
+
+        future.add_done_callback(on_done)
+        return future
+
+    @staticmethod
+    def __scan_executor_instance() -> ThreadPoolExecutor:
+        with FolderManagement.__executor_lock:
+            if FolderManagement.__scan_executor is None:
+                FolderManagement.__scan_executor = ThreadPoolExecutor(
+                    max_workers=FolderManagement.__scan_workers, thread_name_prefix="folder-scan")
+            return FolderManagement.__scan_executor
+
+    @staticmethod
+    def __scan_directory(directory: str) -> Tuple[List[str], List[OSError]]:
+        """
+        Unlinks all non directory entries of the given directory
+        @param directory: The directory to scan
+        @return: The sub directories found and the errors encountered
+        """
+        sub_directories: List[str] = []
+        errors: List[OSError] = []
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            sub_directories.append(entry.path)
+                        else:
+                            os.unlink(entry.path)
+                    except FileNotFoundError:
+                        # Already removed, e.g. by a concurrent removal of the same tree
+                        continue
+                    except OSError as ex:
+                        errors.append(ex)
+        except FileNotFoundError:
+            pass
+        except OSError as ex:
+            errors.append(ex)
+        return sub_directories, errors
+
+    @staticmethod
+    def __remove_tree(path: Path) -> List[OSError]:
+        """
+        Removes a directory tree. Each directory is scanned once, unlinking its files and collecting its
+        sub directories. Small trees are handled on the calling thread, larger ones are scanned in parallel
+        on the shared scan pool. The then empty directories are removed bottom up.
+        @param path: The root of the tree to remove
+        @return: A list of all errors encountered
+        """
+        if os.path.islink(path):
+            return [OSError(f"Cannot delete a symbolic link: {path}")]
+
+        errors: List[OSError] = []
+        # Parents are always added before their children
+        directories: List[str] = []
+        pending: List[str] = [str(path)]
+
+        while len(pending) > 0 and len(directories) < FolderManagement.__serial_directory_limit:
+            directory: str = pending.pop()
+            directories.append(directory)
+            sub_directories, directory_errors = FolderManagement.__scan_directory(directory)
+            pending.extend(sub_directories)
+            errors.extend(directory_errors)
+
+        if len(pending) > 0:
+            # Scan tasks never wait on the pool themselves, so concurrent removals can share it safely
+            executor: ThreadPoolExecutor = FolderManagement.__scan_executor_instance()
+            running: Set[Future] = set()
+            for directory in pending:
+                directories.append(directory)
+                running.add(executor.submit(FolderManagement.__scan_directory, directory))
+
+            while len(running) > 0:
+                done, running = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    sub_directories, directory_errors = future.result()
+                    errors.extend(directory_errors)
+                    for directory in sub_directories:
+                        directories.append(directory)
+                        running.add(executor.submit(FolderManagement.__scan_directory, directory))
+
+        for directory in reversed(directories):
+            try:
+                os.rmdir(directory)
+            except FileNotFoundError:
+                continue
+            except OSError as ex:
+                errors.append(ex)
+
+        return errors
@@ -0,0 +1,186 @@
+import unittest
+from unittest import mock
+from src.mlflow_wrapper.folder_management import FolderManagement
+import os
+import tempfile
+from pathlib import Path
+
+
+class TestFolderManagement(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.root = Path(self.temp_dir.name)
+
+    def tearDown(self):
+        FolderManagement.wait_for_cleanup()
+        self.temp_dir.cleanup()
+
+    def __populate(self, path: Path, directories: int = 1):
+        for i in range(directories):
+            Path(path, f"nested_{i}", "deeper").mkdir(parents=True, exist_ok=True)
+            for j in range(10):
+                Path(path, f"nested_{i}", "deeper", f"file_{j}.txt").write_text("data")
+        for i in range(10):
+            Path(path, f"file_{i}.txt").write_text("data")
+
+    def __root_entries(self) -> list:
+        return sorted(entry.name for entry in self.root.iterdir())
+
+    def test_create_directory_atomic(self):
+        path = Path(self.root, "download")
+        self.__populate(path)
+
+        created = FolderManagement.create_directory(path, remove_if_exists=True, atomic=True)
+        self.assertEqual(path, created)
+        self.assertTrue(path.exists())
+        self.assertEqual([], list(path.iterdir()))
+
+        self.assertTrue(FolderManagement.wait_for_cleanup(timeout=10))
+        self.assertEqual(["download"], self.__root_entries())
+
+    def test_delete_directory_background(self):
+        path = Path(self.root, "download")
+        # Exceeds the serial limit, so the tree is scanned in parallel
+        self.__populate(path, directories=20)
+
+        future = FolderManagement.delete_directory(path, background=True)
+        self.assertFalse(path.exists())
+        self.assertEqual([], future.result())
+        self.assertEqual([], self.__root_entries())
+
+    def test_delete_directory(self):
+        path = Path(self.root, "download")
+        self.__populate(path, directories=20)
+
+        self.assertIsNone(FolderManagement.delete_directory(path))
+        self.assertFalse(path.exists())
+
+    def test_delete_directory_reports_errors(self):
+        path = Path(self.root, "download")
+        self.__populate(path)
+
+        with mock.patch("os.unlink", side_effect=PermissionError("denied")):
+            with self.assertRaises(OSError):
+                FolderManagement.delete_directory(path)
+        self.assertTrue(path.exists())
+
+    def test_delete_directory_background_reports_errors(self):
+        path = Path(self.root, "download")
+        self.__populate(path)
+
+        with mock.patch("os.unlink", side_effect=PermissionError("denied")):
+            with self.assertLogs("src.mlflow_wrapper.folder_management", level="ERROR"):
+                future = FolderManagement.delete_directory(path, background=True)
+                self.assertNotEqual([], future.result())
+                FolderManagement.wait_for_cleanup()
+
+        # The tombstone is left behind and can be removed later on
+        self.assertEqual(1, len(self.__root_entries()))
+        self.assertEqual(1, len(FolderManagement.cleanup_tombstones(self.root)))
+        self.assertEqual([], self.__root_entries())
+
+    def test_cleanup_tombstones_skips_running_removal(self):
+        path = Path(self.root, "download")
+        self.__populate(path, directories=200)
+
+        future = FolderManagement.delete_directory(path, background=True)
+        # The tombstone is still being removed in the background and must not be touched
+        self.assertEqual([], FolderManagement.cleanup_tombstones(self.root))
+        self.assertEqual([], future.result())
+        self.assertTrue(FolderManagement.wait_for_cleanup(timeout=10))
+        self.assertEqual([], self.__root_entries())
+
+    def test_cleanup_tombstones_collects_staging(self):
+        stale = Path(self.root, ".download.staging-0123")
+        self.__populate(stale)
+
+        with FolderManagement.staged_directory(Path(self.root, "download")) as staging_path:
+            Path(staging_path, "new.txt").write_text("data")
+            # Only the staging directory left behind by a killed process is removed
+            self.assertEqual([stale], FolderManagement.cleanup_tombstones(self.root))
+            self.assertTrue(staging_path.exists())
+
+        self.assertEqual(["download"], self.__root_entries())
+
+    def test_not_a_directory(self):
+        path = Path(self.root, "download")
+        path.write_text("data")
+
+        with self.assertRaises(NotADirectoryError):
+            FolderManagement.delete_directory(path)
+        with self.assertRaises(NotADirectoryError):
+            FolderManagement.delete_directory(path, background=True)
+        with self.assertRaises(NotADirectoryError):
+            FolderManagement.create_directory(path, remove_if_exists=True)
+        with self.assertRaises(NotADirectoryError):
+            FolderManagement.create_directory(path, remove_if_exists=True, atomic=True)
+
+        self.assertEqual(["download"], self.__root_entries())
+        self.assertEqual("data", path.read_text())
+
+    def test_delete_directory_symlink(self):
+        target = Path(self.root, "real")
+        self.__populate(target)
+        link = Path(self.root, "link")
+        os.symlink(target, link, target_is_directory=True)
+
+        with self.assertRaises(OSError):
+            FolderManagement.delete_directory(link)
+        with self.assertRaises(OSError):
+            FolderManagement.delete_directory(link, background=True)
+
+        self.assertTrue(link.is_symlink())
+        self.assertEqual(10, len(list(target.glob("file_*.txt"))))
+        self.assertEqual(["link", "real"], self.__root_entries())
+
+    def test_staged_directory(self):
+        path = Path(self.root, "download")
+        self.__populate(path)
+
+        with FolderManagement.staged_directory(path) as staging_path:
+            Path(staging_path, "new.txt").write_text("data")
+            self.assertEqual(10, len(list(path.glob("file_*.txt"))))
+
+        self.assertEqual(["new.txt"], [entry.name for entry in path.iterdir()])
+        self.assertTrue(FolderManagement.wait_for_cleanup(timeout=10))
+        self.assertEqual(["download"], self.__root_entries())
+
+    def test_staged_directory_failure(self):
+        path = Path(self.root, "download")
+        self.__populate(path)
+
+        with self.assertRaises(RuntimeError):
+            with FolderManagement.staged_directory(path) as staging_path:
+                Path(staging_path, "new.txt").write_text("data")
+                raise RuntimeError("Download failed")
+
+        self.assertEqual(10, len(list(path.glob("file_*.txt"))))
+        self.assertFalse(Path(path, "new.txt").exists())
+        self.assertTrue(FolderManagement.wait_for_cleanup(timeout=10))
+        self.assertEqual(["download"], self.__root_entries())
+
+    def test_staged_directory_replace_failure(self):
+        path = Path(self.root, "download")
+        self.__populate(path)
+
+        original_replace = os.replace
+
+        def failing_replace(source, destination):
+            if ".staging-" in str(source) and ".trash-" not in str(destination):
+                raise OSError("replace failed")
+            return original_replace(source, destination)
+
+        with mock.patch("os.replace", side_effect=failing_replace):
+            with self.assertRaises(OSError):
+                with FolderManagement.staged_directory(path) as staging_path:
+                    Path(staging_path, "new.txt").write_text("data")
+
+        # The previous target is restored and nothing is left behind
+        self.assertEqual(10, len(list(path.glob("file_*.txt"))))
+        self.assertTrue(FolderManagement.wait_for_cleanup(timeout=10))
+        self.assertEqual(["download"], self.__root_entries())
+
+
+if __name__ == '__main__':
+    unittest.main()